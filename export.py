@@ -2,14 +2,50 @@
 """Export MacWhisper transcription sessions to Obsidian markdown notes."""
 
 import json
+import os
 import re
 import sqlite3
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:  # optional speedup for large state files
+    orjson = None
+
 SCRIPT_DIR = Path(__file__).resolve().parent
 CONFIG_FILE = SCRIPT_DIR / "config.json"
 
+_UNSAFE_TABLE = str.maketrans(dict.fromkeys('/\\:*?"<>|', "-"))
+_WS_RE = re.compile(r"\s+")
+
+# Fixed fragments of a rendered note, see render_note()
+_NOTE_DATE = b"---\ndate: "
+_NOTE_DURATION = b'\nduration: "'
+_NOTE_LANGUAGE = b'"\nlanguage: '
+_NOTE_SOURCE = b"\nsource: "
+_NOTE_ID = b"\nmacwhisper_id: "
+_NOTE_TITLE = b"\n---\n\n# "
+_NOTE_SUMMARY = b"\n\n## Summary\n\n"
+_NOTE_TRANSCRIPT = b"\n\n## Transcript\n\n"
+
+MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+MAX_PENDING = 32  # sessions fetched but not yet written
+
+if orjson is not None:
+    _loads = orjson.loads
+
+    def _dumps(obj):
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+
+else:
+    _loads = json.loads
+
+    def _dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
 
 def load_config():
     """Load configuration from config.json next to the script."""
@@ -44,70 +80,139 @@ def format_duration(seconds):
 
 def sanitize_filename(title):
     """Replace unsafe characters and trim to 200 chars."""
-    name = re.sub(r'[/\\:*?"<>|]', "-", title)
-    name = re.sub(r"\s+", " ", name).strip()
+    name = title.translate(_UNSAFE_TABLE)
+    name = _WS_RE.sub(" ", name).strip()
     return name[:200]
 
 
 def get_title(session):
     """Pick the best available title by priority."""
     for field in ("userChosenTitle", "aiTitle", "aiSummaryShort", "originalFilename"):
-        value = session.get(field)
+        value = session[field]
         if value and value.strip():
             return value.strip()
     return "Untitled"
 
 
-def render_note(session):
-    """Build the full markdown string for an Obsidian note."""
-    title = get_title(session)
-    date = (session["dateCreated"] or "")[:10]
-    duration = format_duration(session["playbackDuration"])
-    language = session.get("detectedLanguage") or ""
-    source = session.get("originalFilename") or ""
-    uuid_hex = session["id"]
-
-    lines = [
-        "---",
-        f"date: {date}",
-        f'duration: "{duration}"',
-        f"language: {language}",
-        f"source: {source}",
-        f"macwhisper_id: {uuid_hex}",
-        "---",
-        "",
-        f"# {title}",
-    ]
-
-    ai_summary = session.get("aiSummary")
+def get_date(session):
+    """Return the creation date of a session as YYYY-MM-DD."""
+    return (session["dateCreated"] or "")[:10]
+
+
+def render_note(session, title, date):
+    """Build the full markdown note for Obsidian as UTF-8 bytes."""
+    buf = bytearray(_NOTE_DATE)
+    buf += date.encode("utf-8")
+    buf += _NOTE_DURATION
+    buf += format_duration(session["playbackDuration"]).encode("utf-8")
+    buf += _NOTE_LANGUAGE
+    buf += (session["detectedLanguage"] or "").encode("utf-8")
+    buf += _NOTE_SOURCE
+    buf += (session["originalFilename"] or "").encode("utf-8")
+    buf += _NOTE_ID
+    buf += session["id"].encode("utf-8")
+    buf += _NOTE_TITLE
+    buf += title.encode("utf-8")
+
+    ai_summary = session["aiSummary"]
     if ai_summary and ai_summary.strip():
-        lines += ["", "## Summary", "", ai_summary.strip()]
+        buf += _NOTE_SUMMARY
+        buf += ai_summary.strip().encode("utf-8")
 
-    full_text = session.get("fullText")
+    full_text = session["fullText"]
     if full_text and full_text.strip():
-        lines += ["", "## Transcript", "", full_text.strip()]
+        buf += _NOTE_TRANSCRIPT
+        buf += full_text.strip().encode("utf-8")
 
-    lines.append("")  # trailing newline
-    return "\n".join(lines)
+    buf += b"\n"  # trailing newline
+    return buf
 
 
-def load_state(state_file):
-    """Load the incremental export state from disk."""
-    if state_file.exists():
-        with open(state_file, "r", encoding="utf-8") as f:
-            return json.load(f).get("exported", {})
-    return {}
+def get_db_mtime(db_path):
+    """Return the mtimes of the database and its WAL file, if any.
+
+    MacWhisper keeps its database in WAL mode, so recent writes may only
+    touch the -wal file until the next checkpoint.
+    """
+    mtimes = [db_path.stat().st_mtime_ns]
+    try:
+        wal_stat = db_path.with_name(db_path.name + "-wal").stat()
+    except FileNotFoundError:
+        return mtimes
+    # An empty WAL (e.g. just created by a reader) holds no changes
+    if wal_stat.st_size:
+        mtimes.append(wal_stat.st_mtime_ns)
+    return mtimes
 
 
-def save_state(state, state_file):
-    """Persist the export state to disk."""
-    with open(state_file, "w", encoding="utf-8") as f:
-        json.dump({"exported": state}, f, ensure_ascii=False, indent=2)
-        f.write("\n")
+def load_state(state_file):
+    """Load the export state as ({id: (dateUpdated, filename)}, db_mtime)."""
+    if not state_file.exists():
+        return {}, None
+    raw = _loads(state_file.read_bytes())
+
+    state = {}
+    for uuid_hex, prev in raw.get("exported", {}).items():
+        if isinstance(prev, str):
+            # Migrate from old format (just dateUpdated string)
+            state[uuid_hex] = (prev, None)
+        else:
+            state[uuid_hex] = (prev.get("dateUpdated", ""), prev.get("filename"))
+    return state, raw.get("db_mtime")
+
+
+def save_state(state, db_mtime, state_file):
+    """Persist the export state to disk, replacing the old file atomically."""
+    exported = {
+        uuid_hex: {"dateUpdated": date_updated, "filename": filename}
+        for uuid_hex, (date_updated, filename) in state.items()
+    }
+    tmp_file = state_file.with_name(state_file.name + ".tmp")
+    data = _dumps({"db_mtime": db_mtime, "exported": exported})
+    tmp_file.write_bytes(data + b"\n")
+    os.replace(tmp_file, state_file)
+
+
+def load_prev_table(conn, state):
+    """Upload the export state into a TEMP table so SQLite can diff against it."""
+    conn.execute(
+        "CREATE TEMP TABLE prev (id TEXT PRIMARY KEY, dateUpdated, filename TEXT)"
+    )
+    conn.executemany(
+        "INSERT INTO prev VALUES (?, ?, ?)",
+        ((uuid_hex, date, filename) for uuid_hex, (date, filename) in state.items()),
+    )
 
 
 def get_sessions(conn):
-    """Fetch all sessions from the MacWhisper database."""
+    """Yield sessions that are new or updated since the last export.
+
+    Only id and dateUpdated are read here, so SQLite can answer the query
+    from a covering index on the session table when MacWhisper provides
+    one. Use get_session() to load the full row for a session before
+    exporting it.
+    """
+    yield from conn.execute(
+        """
+        SELECT
+            hex(s.id) AS id,
+            IFNULL(s.dateUpdated, '') AS dateUpdated,
+            p.id IS NULL AS isNew,
+            p.filename AS prevFilename
+        FROM session s
+        LEFT JOIN prev p ON p.id = hex(s.id)
+        WHERE p.id IS NULL OR p.dateUpdated <> IFNULL(s.dateUpdated, '')
+        """
+    )
+
+
+def count_sessions(conn):
+    """Return the total number of sessions in the database."""
+    return conn.execute("SELECT count(*) FROM session").fetchone()[0]
+
+
+def get_session(conn, uuid_hex):
+    """Fetch a single session with all columns needed to render a note."""
     cursor = conn.execute(
         """
         SELECT
@@ -123,16 +228,15 @@ def get_sessions(conn):
             detectedLanguage,
             originalFilename
         FROM session
-        """
+        WHERE id = ?
+        """,
+        (bytes.fromhex(uuid_hex),),
     )
-    columns = [desc[0] for desc in cursor.description]
-    return [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return cursor.fetchone()
 
 
-def export_session(session, output_dir, used_filenames):
-    """Write a single session to a markdown file. Returns the filename."""
-    title = get_title(session)
-    date = (session["dateCreated"] or "")[:10]
+def assign_filename(title, date, used_filenames):
+    """Pick a unique filename for a note and reserve it in used_filenames."""
     base = sanitize_filename(f"{date} {title}")
 
     # Deduplicate filenames within a single export run
@@ -142,13 +246,15 @@ def export_session(session, output_dir, used_filenames):
         filename = f"{base} ({counter}).md"
         counter += 1
     used_filenames.add(filename)
+    return filename
 
-    content = render_note(session)
-    filepath = output_dir / filename
-    with open(filepath, "w", encoding="utf-8") as f:
-        f.write(content)
 
-    return filename
+def export_session(session, title, date, filepath):
+    """Write a single session to a markdown file."""
+    data = render_note(session, title, date)
+    # Size the buffer to the note so it goes out in one write() syscall
+    with open(filepath, "wb", buffering=max(len(data), 65536)) as f:
+        f.write(data)
 
 
 def main():
@@ -158,63 +264,81 @@ def main():
         print(f"Error: database not found at {db_path}", file=sys.stderr)
         sys.exit(1)
 
-    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    state, prev_db_mtime = load_state(state_file)
+    db_mtime = get_db_mtime(db_path)
+    if db_mtime == prev_db_mtime:
+        print("Done: database unchanged since last export")
+        return
+
+    conn = sqlite3.connect(
+        f"file:{db_path}?mode=ro", uri=True, isolation_level=None
+    )
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA cache_size = -65536")  # 64 MB page cache
+    conn.execute("PRAGMA temp_store = MEMORY")
+    conn.execute("PRAGMA mmap_size = 268435456")  # 256 MB
+    # Hold one read snapshot for the whole export
+    conn.execute("BEGIN")
     try:
         output_dir.mkdir(parents=True, exist_ok=True)
-        state = load_state(state_file)
-        sessions = get_sessions(conn)
+        load_prev_table(conn, state)
 
         new_count = 0
         updated_count = 0
-        skipped_count = 0
 
         new_state = dict(state)
-        used_filenames = set()
-
-        for session in sessions:
-            uuid_hex = session["id"]
-            date_updated = session["dateUpdated"] or ""
-
-            prev = state.get(uuid_hex)
-            if isinstance(prev, dict):
-                prev_date = prev.get("dateUpdated", "")
-                prev_filename = prev.get("filename")
-            elif isinstance(prev, str):
-                # Migrate from old format (just dateUpdated string)
-                prev_date = prev
-                prev_filename = None
-            else:
-                prev_date = None
-                prev_filename = None
-
-            if prev_date is None:
-                # New session
-                fname = export_session(session, output_dir, used_filenames)
-                new_state[uuid_hex] = {"dateUpdated": date_updated, "filename": fname}
-                new_count += 1
-            elif prev_date != date_updated:
-                # Updated session — remove old file if title changed
-                if prev_filename:
-                    old_path = output_dir / prev_filename
-                    if old_path.exists():
-                        old_path.unlink()
-
-                fname = export_session(session, output_dir, used_filenames)
-                new_state[uuid_hex] = {"dateUpdated": date_updated, "filename": fname}
-                updated_count += 1
-            else:
-                # Keep existing filename in used set to avoid collisions
-                if prev_filename:
-                    used_filenames.add(prev_filename)
-                skipped_count += 1
-
-        save_state(new_state, state_file)
 
+        existing = {entry.name for entry in os.scandir(output_dir)}
+
+        # Keep previously exported filenames in used set to avoid collisions
+        used_filenames = {fname for _, fname in state.values() if fname}
+
+        futures = []
+        pending = threading.BoundedSemaphore(MAX_PENDING)
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            for row in get_sessions(conn):
+                uuid_hex = row["id"]
+                date_updated = row["dateUpdated"]
+                prev_filename = row["prevFilename"]
+
+                if row["isNew"]:
+                    new_count += 1
+                else:
+                    # Updated session — remove old file if title changed
+                    if prev_filename:
+                        if prev_filename in existing:
+                            (output_dir / prev_filename).unlink(missing_ok=True)
+                        used_filenames.discard(prev_filename)
+                    updated_count += 1
+
+                # This thread fetches rows and assigns filenames serially while
+                # the pool renders and writes; block once MAX_PENDING sessions
+                # are waiting so memory stays bounded.
+                pending.acquire()
+                session = get_session(conn, uuid_hex)
+                title = get_title(session)
+                date = get_date(session)
+                fname = assign_filename(title, date, used_filenames)
+                future = executor.submit(
+                    export_session, session, title, date, output_dir / fname
+                )
+                future.add_done_callback(lambda _: pending.release())
+                futures.append(future)
+                new_state[uuid_hex] = (date_updated, fname)
+
+        for future in futures:
+            future.result()
+
+        save_state(new_state, db_mtime, state_file)
+
+        total = count_sessions(conn)
+        skipped_count = total - new_count - updated_count
         print(
             f"Done: {new_count} new, {updated_count} updated, "
-            f"{skipped_count} skipped (total {len(sessions)} sessions)"
+            f"{skipped_count} skipped (total {total} sessions)"
         )
     finally:
+        conn.commit()
         conn.close()
 
 